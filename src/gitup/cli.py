@@ -6,6 +6,8 @@
 import argparse
 import os
 import platform
+import re
+import time
 
 from colorama import init as color_init, Style
 
@@ -18,7 +20,61 @@ from gitup.config import (
     list_bookmarks,
     clean_bookmarks,
 )
-from gitup.update import update_bookmarks, update_directories, run_command
+from gitup.journal import (
+    Journal,
+    get_default_journal_dir,
+    get_fingerprint,
+    get_journal_path,
+)
+from gitup.metrics import write_metrics
+from gitup.render import (
+    BOLD,
+    GREEN,
+    INDENT1,
+    RED,
+    YELLOW,
+    LiveProgress,
+    render,
+)
+from gitup.update import (
+    Options,
+    Throttle,
+    iter_updates,
+    iter_commands,
+    iter_maintenance,
+    lower_priority,
+)
+
+
+def _parse_shard(value):
+    """Parse a shard specification of the form INDEX/COUNT."""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected INDEX/COUNT, like 1/4: {0!r}".format(value)
+        )
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "shard index must be between 1 and {0}: {1!r}".format(count, value)
+        )
+    return index, count
+
+
+def _parse_rate(value):
+    """Parse a bandwidth limit in bytes per second, like 500K or 2M."""
+    units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    match = re.fullmatch(r"(\d+(?:\.\d*)?)([KMG]?)", value.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "expected a positive rate, like 500K or 2M: {0!r}".format(value)
+        )
+    rate = int(float(match.group(1)) * units[match.group(2)])
+    if rate < 1:
+        raise argparse.ArgumentTypeError(
+            "rate must be at least 1 byte per second: {0!r}".format(value)
+        )
+    return rate
 
 
 def _build_parser():
@@ -61,6 +117,15 @@ def _build_parser():
         help="""max recursion depth when searching for repos in subdirectories
         (default: 3; use 0 for no recursion, or -1 for unlimited)""",
     )
+    group_u.add_argument(
+        "-s",
+        "--shard",
+        type=_parse_shard,
+        metavar="i/n",
+        help="""split the repos into n shards and only update the i-th one
+        (1-based); each repo is assigned to exactly one shard by a stable hash
+        of its path, for spreading work across machines""",
+    )
     group_u.add_argument(
         "-c",
         "--current-only",
@@ -74,6 +139,21 @@ def _build_parser():
         action="store_true",
         help="only fetch remotes, don't try to fast-forward any branches",
     )
+    group_u.add_argument(
+        "--submodules",
+        action="store_true",
+        help="""also update each repo's initialized submodules, several at a
+        time (see --jobs); submodules with the same URL are only fetched from
+        the network once""",
+    )
+    group_u.add_argument(
+        "-m",
+        "--maintain",
+        action="store_true",
+        help="""after updating, run git's background maintenance tasks
+        (deferred auto-gc, commit-graph, and multi-pack-index writes) on each
+        repo at low priority, to speed up later runs""",
+    )
     group_u.add_argument(
         "-p",
         "--prune",
@@ -131,6 +211,45 @@ def _build_parser():
         metavar="command",
         help="run a shell command on all repos",
     )
+    group_a.add_argument(
+        "-j",
+        "--jobs",
+        metavar="n",
+        type=int,
+        default=4,
+        help="""max number of submodules to update, or repos to maintain,
+        concurrently (default: 4)""",
+    )
+    group_a.add_argument(
+        "--background",
+        action="store_true",
+        help="""run gitup and all of its git processes at low CPU and IO
+        priority, so it doesn't compete with other work on the machine""",
+    )
+    group_a.add_argument(
+        "--bandwidth",
+        type=_parse_rate,
+        metavar="rate",
+        help="""limit the data received by all fetches to about this many
+        bytes per second (e.g. 500K or 2M), pausing new fetches as needed""",
+    )
+    group_a.add_argument(
+        "--metrics-file",
+        metavar="path",
+        help="""when done, write metrics about the run (fetch times and sizes,
+        skips, errors) to this file in the OpenMetrics text format, e.g. for
+        node_exporter's textfile collector""",
+    )
+    group_a.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="""skip repos already finished by the last run if it was
+        interrupted (progress is journaled in {0}, separately for each
+        bookmark file, set of paths, shard, and update mode)""".format(
+            get_default_journal_dir()
+        ),
+    )
 
     group_m.add_argument(
         "-h", "--help", action="help", help="show this help message and exit"
@@ -150,6 +269,26 @@ def _build_parser():
     return parser
 
 
+def _render_maintenance(paths, options):
+    """Run background maintenance at low priority, printing the results."""
+    if not paths:
+        return []
+    count = len(set(paths))
+    suffix = "" if count == 1 else "s"
+    print(BOLD + "Maintaining", "{0} repo{1}:".format(count, suffix))
+    lower_priority()
+
+    results = []
+    for result in iter_maintenance(paths, options):
+        print(INDENT1, BOLD + result.path + ":", end=" ")
+        if result.status == "error":
+            print(RED + "error:", result.message)
+        else:
+            print(GREEN + "done", end=".\n")
+        results.append(result)
+    return results
+
+
 def _selftest():
     """Run the integrated test suite with pytest."""
     from .test import run_tests
@@ -187,17 +326,88 @@ def main():
         clean_bookmarks(args.bookmark_file)
         acted = True
 
+    if args.command:
+        update_marks = args.update or not args.directories_to_update
+    else:
+        update_marks = args.update or not (acted or args.directories_to_update)
+    if not (update_marks or args.directories_to_update):
+        return
+
+    if args.background:
+        lower_priority()
+    start = time.monotonic()
+    bookmarks = get_bookmarks(args.bookmark_file) if update_marks else []
+    targets = [os.path.abspath(path) for path in args.directories_to_update]
+    shard = "{0}/{1}".format(*args.shard) if args.shard else None
+    bookmark_file = None
+    if update_marks:
+        bookmark_file = os.path.abspath(args.bookmark_file or get_default_config_path())
+    # Options changing which repos are found, or what it means to finish one:
+    modes = ["--depth={0}".format(args.max_depth)] + [
+        flag
+        for flag, enabled in [
+            ("--current-only", args.current_only),
+            ("--fetch-only", args.fetch_only),
+            ("--submodules", args.submodules),
+        ]
+        if enabled
+    ]
+    key = get_fingerprint(args.command, targets, bookmark_file, shard, modes)
+    fingerprint = get_fingerprint(args.command, targets, bookmarks)
+    journal = Journal(get_journal_path(key), fingerprint)
+    try:
+        if not journal.open(args.resume):
+            return
+    except OSError as err:
+        print(YELLOW + "Warning:", "can't keep a journal for --resume:", err)
+        print()
+        journal = None
+
+    options = Options(
+        max_depth=args.max_depth,
+        current_only=args.current_only,
+        fetch_only=args.fetch_only,
+        prune=args.prune,
+        command=args.command,
+        shard=args.shard,
+        submodules=args.submodules,
+        maintain=args.maintain,
+        count_received=bool(args.metrics_file),
+        jobs=args.jobs,
+        bandwidth=args.bandwidth,
+        journal=journal,
+        progress=LiveProgress(),
+    )
+
+    repos, maintained = [], []
     if args.command:
         if args.directories_to_update:
-            run_command(args.directories_to_update, args)
-        if args.update or not args.directories_to_update:
-            run_command(get_bookmarks(args.bookmark_file), args)
+            repos += render(iter_commands(args.directories_to_update, options))
+        if update_marks:
+            repos += render(iter_commands(bookmarks, options))
     else:
+        throttle = Throttle(args.bandwidth)  # Shared by both passes
         if args.directories_to_update:
-            update_directories(args.directories_to_update, args)
-            acted = True
-        if args.update or not acted:
-            update_bookmarks(get_bookmarks(args.bookmark_file), args)
+            results = iter_updates(args.directories_to_update, options, throttle)
+            repos += render(results, options.progress)
+        if update_marks:
+            if bookmarks:
+                results = iter_updates(bookmarks, options, throttle)
+                repos += render(results, options.progress)
+            else:
+                print(
+                    "You don't have any bookmarks configured!",
+                    "Get help with 'gitup -h'.",
+                )
+        if args.maintain:
+            paths = [repo.path for repo in repos]
+            maintained = _render_maintenance(paths, options)
+
+    if journal:
+        journal.close()
+    if args.metrics_file:
+        duration = time.monotonic() - start
+        write_metrics(args.metrics_file, repos, maintained, duration)
 
 
 def run():
@@ -205,4 +415,4 @@ def run():
     try:
         main()
     except KeyboardInterrupt:
-        print("Stopped by user.")
+        print("Stopped by user. Pass --resume to pick up where this run left off.")
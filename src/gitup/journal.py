@@ -0,0 +1,179 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2011-2025 Ben Kurtovic <ben.kurtovic@gmail.com>
+# Released under the terms of the MIT License. See LICENSE for details.
+
+from hashlib import sha1
+import os
+
+from colorama import Fore, Style
+
+from gitup.config import get_default_config_path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+__all__ = ["get_default_journal_dir", "get_journal_path", "get_fingerprint", "Journal"]
+
+YELLOW = Fore.YELLOW + Style.BRIGHT
+RED = Fore.RED + Style.BRIGHT
+
+HEADER = "# gitup journal "
+
+
+def get_default_journal_dir():
+    """Return the default directory holding checkpoint journals."""
+    return os.path.join(os.path.dirname(get_default_config_path()), "journals")
+
+
+def get_journal_path(key, journal_dir=None):
+    """Return the path to the journal of the run identified by the given key.
+
+    The key (see get_fingerprint()) should identify the job, such as its
+    bookmark file and shard, so that separate jobs never share a journal.
+    """
+    return os.path.join(journal_dir or get_default_journal_dir(), key)
+
+
+def get_fingerprint(*parts):
+    """Return a short hash identifying the set of targets of a run.
+
+    Each part is either a string or a list of strings (such as the list of
+    bookmarks); order within lists doesn't matter.
+    """
+    digest = sha1()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = "\n".join(sorted(part))
+        digest.update((part or "").encode("utf8") + b"\0")
+    return digest.hexdigest()[:16]
+
+
+class Journal:
+    """Records each completed repo so an interrupted run can be resumed.
+
+    The journal is a plain text file: a header line containing the run's
+    fingerprint, followed by one ``<result>\\t<path>`` line per completed repo.
+    It is appended to (and flushed) as the run progresses, and removed once the
+    run finishes cleanly. The file is locked while in use, so only one run at a
+    time can use a given journal.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = path
+        self.fingerprint = fingerprint
+        self._previous = {}
+        self._file = None
+
+    def _lock(self):
+        """Try to lock the journal file, returning whether we succeeded."""
+        try:
+            if fcntl:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _load(self):
+        """Read a previous journal, returning False if it can't be resumed."""
+        self._file.seek(0)
+        lines = self._file.read().decode("utf8").splitlines()
+        if not lines:
+            return False
+        if lines[0] != HEADER + self.fingerprint:
+            print(
+                YELLOW + "Warning:",
+                "the set of repos has changed since the interrupted run;",
+                "starting over.",
+            )
+            print()
+            return False
+        for line in lines[1:]:
+            result, sep, path = line.partition("\t")
+            if sep:
+                self._previous[path] = result
+        return True
+
+    def open(self, resume=False):
+        """Start the journal, resuming a previous one if requested.
+
+        Return False if another run is already using it. Raise OSError if the
+        journal can't be created.
+        """
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._file = open(self.path, "a+b")
+        if not self._lock():
+            self._file.close()
+            self._file = None
+            print(RED + "Error:", "another run is already using", self.path)
+            return False
+
+        if resume and self._load():
+            count = sum(1 for path in self._previous if self.is_done(path))
+            if count:
+                suffix = "" if count == 1 else "s"
+                print(
+                    "Resuming interrupted run ({0} repo{1} already done).".format(
+                        count, suffix
+                    )
+                )
+                print()
+            return True
+        self._previous = {}
+        self._file.truncate(0)
+        self._write(HEADER + self.fingerprint)
+        return True
+
+    def _write(self, line):
+        """Append a line to the journal and make sure it hits the disk."""
+        self._file.write(line.encode("utf8") + b"\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def is_done(self, path):
+        """Return whether the interrupted run completed the given repo path.
+
+        Repos that failed are not considered done, so they are retried.
+        """
+        return self._previous.get(path, "error") != "error"
+
+    def record(self, path, result):
+        """Record that the given repo path was completed with a result.
+
+        If the journal can't be written to, a warning is printed and the rest
+        of the run goes unrecorded.
+        """
+        if not self._file:
+            return
+        try:
+            self._write("{0}\t{1}".format(result, path))
+        except OSError as err:
+            print(YELLOW + "Warning:", "can't write to the journal:", err)
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """Finish the run, removing the journal since it's no longer needed."""
+        if not self._file:
+            return
+        try:
+            os.remove(self.path)  # While still locked, where the OS allows it
+            removed = True
+        except OSError:
+            removed = False
+        self._file.close()
+        self._file = None
+        if not removed:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
@@ -0,0 +1,176 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2011-2025 Ben Kurtovic <ben.kurtovic@gmail.com>
+# Released under the terms of the MIT License. See LICENSE for details.
+
+from collections import Counter
+import os
+import tempfile
+import time
+
+__all__ = ["format_metrics", "write_metrics"]
+
+PREFIX = "gitup_"
+
+
+def _escape(value):
+    """Escape a label value for the OpenMetrics text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _reason(message):
+    """Turn a skip message into a short label value."""
+    return (message or "unknown").rstrip(".")
+
+
+class _Family:
+    """A metric family: its metadata and samples, in the order added."""
+
+    def __init__(self, name, help_text):
+        self.name = PREFIX + name
+        self.help_text = help_text
+        self.samples = []
+
+    def add(self, value, **labels):
+        """Add a sample with the given labels."""
+        self.samples.append((labels, value))
+
+    def format(self):
+        """Return the lines describing this family."""
+        lines = [
+            "# TYPE {0} gauge".format(self.name),
+            "# HELP {0} {1}".format(self.name, self.help_text),
+        ]
+        for labels, value in self.samples:
+            pairs = ",".join(
+                '{0}="{1}"'.format(key, _escape(val)) for key, val in labels.items()
+            )
+            name = self.name + ("{" + pairs + "}" if pairs else "")
+            if isinstance(value, float):
+                value = repr(round(value, 6))
+            lines.append("{0} {1}".format(name, value))
+        return lines
+
+
+def _walk(results):
+    """Yield each repo result, followed by its submodules, recursively."""
+    for result in results:
+        yield result
+        yield from _walk(result.submodules)
+
+
+def format_metrics(results, maintenance=(), duration=None, timestamp=None):
+    """Return OpenMetrics text describing a run, given its RepoResults.
+
+    *maintenance* holds the RepoResults of the --maintain phase, if any.
+    Resumed repos, which weren't touched by this run, are only counted.
+    """
+    statuses = Counter()
+    skips = Counter()
+    errors = Counter()
+
+    fetch_duration = _Family(
+        "fetch_duration_seconds", "Time taken to fetch each remote."
+    )
+    fetch_objects = _Family(
+        "fetch_objects_received", "Number of objects received by each fetch."
+    )
+    fetch_bytes = _Family(
+        "fetch_received_bytes", "Number of bytes received by each fetch."
+    )
+    fetch_success = _Family(
+        "fetch_success", "Whether each remote was fetched successfully."
+    )
+    fast_forwarded = _Family(
+        "branches_fast_forwarded", "Number of branches fast-forwarded in each repo."
+    )
+
+    for repo in _walk(results):
+        statuses[repo.status] += 1
+        if repo.status == "resumed":
+            continue
+        if repo.message:
+            errors["repo"] += 1
+        elif repo.status == "error" and not (repo.remotes or repo.submodules):
+            errors["command"] += 1  # The command exited with a nonzero status
+
+        for remote in repo.remotes:
+            if remote.status == "skipped":
+                skips["remote", _reason(remote.message)] += 1
+                continue
+            if remote.status == "error":
+                errors["fetch"] += 1
+            labels = {"repo": repo.path, "remote": remote.name}
+            fetch_duration.add(float(remote.duration), **labels)
+            fetch_objects.add(remote.objects, **labels)
+            fetch_bytes.add(remote.bytes, **labels)
+            fetch_success.add(int(remote.status == "ok"), **labels)
+
+        if repo.branches:
+            done = sum(1 for branch in repo.branches if branch.status == "done")
+            fast_forwarded.add(done, repo=repo.path)
+        for branch in repo.branches:
+            if branch.status == "skipped":
+                skips["branch", _reason(branch.message)] += 1
+
+    for repo in maintenance:
+        if repo.status == "error":
+            errors["maintenance"] += 1
+
+    repos = _Family("repos", "Number of repos processed, by outcome.")
+    for status, count in sorted(statuses.items()):
+        repos.add(count, status=status)
+    skipped = _Family("skips", "Number of remotes and branches skipped, by reason.")
+    for (kind, reason), count in sorted(skips.items()):
+        skipped.add(count, kind=kind, reason=reason)
+    failed = _Family("errors", "Number of errors, by category.")
+    for category in ("repo", "fetch", "command", "maintenance"):
+        failed.add(errors[category], category=category)
+
+    run = _Family("last_run_timestamp_seconds", "When the run finished.")
+    run.add(float(time.time() if timestamp is None else timestamp))
+    families = [run]
+    if duration is not None:
+        families.append(_Family("run_duration_seconds", "How long the run took."))
+        families[-1].add(float(duration))
+    families += [
+        repos,
+        failed,
+        skipped,
+        fetch_duration,
+        fetch_objects,
+        fetch_bytes,
+        fetch_success,
+        fast_forwarded,
+    ]
+
+    lines = []
+    for family in families:
+        lines += family.format()
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path, results, maintenance=(), duration=None):
+    """Atomically write OpenMetrics text describing a run to the given path.
+
+    The file is written next to its destination and then renamed into place,
+    so a collector (such as node_exporter's textfile collector) never sees a
+    partial file.
+    """
+    text = format_metrics(results, maintenance, duration)
+    dirname = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=dirname, prefix=".gitup-", suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(text.encode("utf8"))
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,192 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2011-2025 Ben Kurtovic <ben.kurtovic@gmail.com>
+# Released under the terms of the MIT License. See LICENSE for details.
+
+import sys
+
+from colorama import Fore, Style
+
+from gitup.update import GroupResult, Progress
+
+__all__ = ["LiveProgress", "render"]
+
+BOLD = Style.BRIGHT
+BLUE = Fore.BLUE + BOLD
+GREEN = Fore.GREEN + BOLD
+RED = Fore.RED + BOLD
+CYAN = Fore.CYAN + BOLD
+YELLOW = Fore.YELLOW + BOLD
+RESET = Style.RESET_ALL
+
+INDENT1 = " " * 3
+INDENT2 = " " * 7
+INDENT3 = " " * 11
+ERROR = RED + "Error:" + RESET
+
+
+def _print_group(group):
+    """Print the header (or error) for a single path given to update."""
+    if group.status == "comment":
+        print(CYAN + BOLD + group.message)
+    elif group.status == "error":
+        print(ERROR, BOLD + group.path, group.message)
+    else:
+        suffix = "" if group.count == 1 else "s"
+        if group.shard:
+            suffix += ", shard {0}/{1}".format(*group.shard)
+        print(BOLD + group.path, "({0} repo{1}):".format(group.count, suffix))
+
+
+def _format_counts(counts):
+    """Return the progress counts of a fetch, like " (12/40, 3)"."""
+    counts = [
+        "{0}/{1}".format(cur, total) if total else str(cur) for cur, total in counts
+    ]
+    return " ({0})".format(", ".join(counts)) if counts else ""
+
+
+def _print_remote(remote, indent=INDENT2):
+    """Print the outcome of fetching a single remote."""
+    progress = _format_counts(remote.counts)
+    print(indent, "Fetching", BOLD + remote.name + RESET + progress, end=": ")
+    _print_fetch_outcome(remote)
+
+
+def _print_fetch_outcome(remote):
+    """Print what happened when fetching a remote, after its name."""
+    info = [
+        (remote.new_heads, "new branch", "new branches"),
+        (remote.new_tags, "new tag", "new tags"),
+        (remote.updated, "branch update", "branch updates"),
+    ]
+    if remote.source:
+        if remote.status == "error":
+            print(RED + "error:", remote.message)
+        else:
+            print(BLUE + "shared", "with", remote.source + ".")
+    elif remote.status == "skipped":
+        print(YELLOW + "skipped:", remote.message)
+    elif remote.status == "error":
+        print(RED + "error:", remote.message)
+    else:
+        rlist = []
+        for names, singular, plural in info:
+            if names:
+                desc = singular if len(names) == 1 else plural
+                colored = GREEN + desc + RESET
+                rlist.append("{0} ({1})".format(colored, ", ".join(names)))
+        print((", ".join(rlist) if rlist else BLUE + "up to date" + RESET) + ".")
+
+
+def _print_branch(branch, indent=INDENT2):
+    """Print the outcome of updating a single branch."""
+    print(indent, "Updating", BOLD + branch.name, end=": ")
+    if branch.status == "skipped":
+        print(YELLOW + "skipped:", branch.message)
+    elif branch.status == "done":
+        print(GREEN + "done", end=".\n")
+    else:
+        print(BLUE + "up to date", end=".\n")
+
+
+def _print_repo(repo, live=False):
+    """Print the outcome of updating (or running a command on) a repo.
+
+    If *live* is True, its progress has already been printed as it happened,
+    so only the parts not reported along the way are left.
+    """
+    if repo.status == "resumed":
+        print(INDENT1, BOLD + repo.name + ":", BLUE + "already done", end=".\n")
+        return
+    if live:
+        if repo.message:
+            print(INDENT2, ERROR, repo.message)
+        return
+    print(INDENT1, BOLD + repo.name + ":")
+    if repo.message:
+        print(INDENT2, ERROR, repo.message)
+    for remote in repo.remotes:
+        _print_remote(remote)
+    for branch in repo.branches:
+        _print_branch(branch)
+    for line in repo.output:
+        print(INDENT2, line)
+    for module in repo.submodules:
+        _print_submodule(module)
+
+
+def _print_submodule(module):
+    """Print the outcome of updating a submodule, nested under its parent."""
+    print(INDENT2, "Submodule", BOLD + module.name + ":")
+    if module.message:
+        print(INDENT3, ERROR, module.message)
+    for remote in module.remotes:
+        _print_remote(remote, INDENT3)
+    for branch in module.branches:
+        _print_branch(branch, INDENT3)
+
+
+class LiveProgress(Progress):
+    """Prints each step of an update as it happens.
+
+    Fetch counts are only redrawn while running if we're writing to a terminal.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._redraws = sys.stdout.isatty()
+        self._fetching = None
+        self._shown = ""
+
+    def _redraw(self, text):
+        """Replace the progress text shown on the current line."""
+        padding = max(len(self._shown) - len(text), 0)
+        erase = "\b" * len(self._shown)
+        print(erase + text + " " * padding + "\b" * padding, end="", flush=True)
+        self._shown = text
+
+    def repo_started(self, name, path):
+        self.path = path
+        print(INDENT1, BOLD + name + ":")
+
+    def fetch_started(self, name):
+        self._fetching = name
+        self._shown = ""
+        print(INDENT2, "Fetching", BOLD + name + RESET, end="", flush=True)
+
+    def fetch_progress(self, name, counts):
+        if self._redraws:
+            self._redraw(_format_counts(counts))
+
+    def fetch_finished(self, result):
+        if self._fetching == result.name:
+            self._redraw(_format_counts(result.counts))
+            print(end=": ")
+            _print_fetch_outcome(result)
+        else:
+            _print_remote(result)
+        self._fetching = None
+
+    def branch_finished(self, result):
+        _print_branch(result)
+
+    def submodule_finished(self, result):
+        _print_submodule(result)
+
+
+def render(results, live=None):
+    """Print a stream of update results, returning the RepoResults.
+
+    *live* is the LiveProgress given in the options, if any.
+    """
+    repos = []
+    for result in results:
+        if isinstance(result, GroupResult):
+            _print_group(result)
+        else:
+            _print_repo(result, live is not None and live.path == result.path)
+            if live:
+                live.path = None
+            repos.append(result)
+    return repos
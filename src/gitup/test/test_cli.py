@@ -3,11 +3,16 @@
 # Copyright (C) 2011-2018 Ben Kurtovic <ben.kurtovic@gmail.com>
 # Released under the terms of the MIT License. See LICENSE for details.
 
+import argparse
+import os
 import platform
 import subprocess
 import sys
 
+import pytest
+
 from gitup import __version__
+from gitup.cli import _parse_rate
 
 
 def run_cli(*args):
@@ -21,3 +26,26 @@ def test_cli_version():
     output = run_cli("-v")
     expected = "gitup {} (Python {})".format(__version__, platform.python_version())
     assert output == expected
+
+
+def test_cli_bandwidth():
+    """make sure bandwidth limits are parsed, and tiny ones rejected"""
+    assert _parse_rate("500K") == 500 * 1024
+    assert _parse_rate("1.5m") == 3 << 19
+    assert _parse_rate("1") == 1
+    for value in ("0", "0.5", "0.9", "-1", "fast"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            _parse_rate(value)
+
+
+def test_cli_without_journal(tmpdir):
+    """make sure an unusable config directory doesn't stop an update"""
+    config = tmpdir / "config"
+    config.write("not a directory")
+    repo = tmpdir / "repo"
+    subprocess.check_call(["git", "init", "-q", str(repo)])
+    env = dict(os.environ, XDG_CONFIG_HOME=str(config))
+    cmd = [sys.executable, "-m", "gitup", str(repo)]
+    output = subprocess.check_output(cmd, env=env).decode("utf8")
+    assert "can't keep a journal" in output
+    assert "no remotes configured" in output
@@ -0,0 +1,78 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2011-2025 Ben Kurtovic <ben.kurtovic@gmail.com>
+# Released under the terms of the MIT License. See LICENSE for details.
+
+import os
+
+from gitup.journal import Journal, get_fingerprint, get_journal_path
+
+
+def test_resume(tmpdir, capsys):
+    path = str(tmpdir / "journal")
+    fingerprint = get_fingerprint(None, ["/a", "/b"])
+    journal = Journal(path, fingerprint)
+    journal.open()
+    journal.record("/a/repo", "ok")
+    journal._file.close()  # Interrupted
+
+    resumed = Journal(path, get_fingerprint(None, ["/b", "/a"]))
+    resumed.open(resume=True)
+    assert resumed.is_done("/a/repo")
+    assert not resumed.is_done("/b/repo")
+    resumed.close()
+    assert not os.path.exists(path)
+    assert "1 repo already done" in capsys.readouterr().out
+
+
+def test_resume_changed_targets(tmpdir, capsys):
+    path = str(tmpdir / "journal")
+    journal = Journal(path, get_fingerprint(None, ["/a"]))
+    journal.open()
+    journal.record("/a/repo", "ok")
+    journal._file.close()  # Interrupted
+
+    resumed = Journal(path, get_fingerprint(None, ["/a", "/c"]))
+    resumed.open(resume=True)
+    assert not resumed.is_done("/a/repo")
+    assert "has changed" in capsys.readouterr().out
+
+
+def test_separate_jobs(tmpdir, capsys):
+    fingerprint = get_fingerprint(None, ["/a"])
+    first = get_journal_path(get_fingerprint(None, [], "/bookmarks1"), str(tmpdir))
+    second = get_journal_path(get_fingerprint(None, [], "/bookmarks2"), str(tmpdir))
+    assert first != second
+
+    interrupted = Journal(first, fingerprint)
+    interrupted.open()
+    interrupted.record("/a/repo", "ok")
+    assert not Journal(first, fingerprint).open(resume=True)
+    assert "already using" in capsys.readouterr().out
+    interrupted._file.close()
+
+    other = Journal(second, fingerprint)
+    assert other.open()
+    other.close()
+
+    resumed = Journal(first, fingerprint)
+    assert resumed.open(resume=True)
+    assert resumed.is_done("/a/repo")
+    resumed.close()
+
+
+def test_resume_retries_errors(tmpdir):
+    path = str(tmpdir / "journal")
+    fingerprint = get_fingerprint(None, ["/a"])
+    journal = Journal(path, fingerprint)
+    journal.open()
+    journal.record("/a/good", "ok")
+    journal.record("/a/bad", "error")
+    assert not journal.is_done("/a/good")  # Only for the run being resumed
+    journal._file.close()  # Interrupted
+
+    resumed = Journal(path, fingerprint)
+    resumed.open(resume=True)
+    assert resumed.is_done("/a/good")
+    assert not resumed.is_done("/a/bad")
+    resumed.close()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2011-2025 Ben Kurtovic <ben.kurtovic@gmail.com>
+# Released under the terms of the MIT License. See LICENSE for details.
+
+from gitup.metrics import format_metrics, write_metrics
+from gitup.update import BranchResult, RemoteResult, RepoResult
+
+
+def _results():
+    remote = RemoteResult("origin", objects=12, bytes=2048, duration=0.5)
+    failed = RemoteResult("mirror", "error", "could not resolve host.")
+    branches = [
+        BranchResult("main", "done"),
+        BranchResult("wip", "skipped", "uncommitted changes."),
+    ]
+    return [
+        RepoResult(
+            "foo", "/repos/foo", "error", remotes=[remote, failed], branches=branches
+        )
+    ]
+
+
+def test_format_metrics():
+    text = format_metrics(_results(), duration=1.5, timestamp=100)
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF"
+    assert "gitup_run_duration_seconds 1.5" in lines
+    assert 'gitup_fetch_received_bytes{repo="/repos/foo",remote="origin"} 2048' in lines
+    assert 'gitup_fetch_success{repo="/repos/foo",remote="mirror"} 0' in lines
+    assert 'gitup_branches_fast_forwarded{repo="/repos/foo"} 1' in lines
+    assert 'gitup_skips{kind="branch",reason="uncommitted changes"} 1' in lines
+    assert 'gitup_errors{category="fetch"} 1' in lines
+
+
+def test_write_metrics(tmpdir):
+    path = tmpdir / "gitup.prom"
+    write_metrics(str(path), _results())
+    assert path.read().endswith("# EOF\n")
+    assert tmpdir.listdir() == [path]
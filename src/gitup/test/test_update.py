@@ -0,0 +1,308 @@
+# -*- coding: utf-8  -*-
+#
+# Copyright (C) 2011-2025 Ben Kurtovic <ben.kurtovic@gmail.com>
+# Released under the terms of the MIT License. See LICENSE for details.
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+
+from git import Repo
+import pytest
+
+from gitup import update
+
+
+def test_shards_partition_repos():
+    names = ["repo{0}".format(i) for i in range(100)]
+    shards = [
+        [name for name in names if update._in_shard(name, (i, 4))] for i in range(1, 5)
+    ]
+    assert sorted(sum(shards, [])) == sorted(names)
+    assert all(shard for shard in shards)
+    assert all(update._in_shard(name, None) for name in names)
+
+
+def _make_repos(tmpdir):
+    upstream = Repo.init(str(tmpdir / "upstream"))
+    with upstream.config_writer() as writer:
+        writer.set_value("user", "name", "gitup")
+        writer.set_value("user", "email", "gitup@example.com")
+    upstream.index.commit("first")
+    upstream.clone(str(tmpdir / "repos" / "clone"))
+    upstream.index.commit("second")
+    return str(tmpdir / "repos")
+
+
+def test_iter_updates(tmpdir):
+    path = _make_repos(tmpdir)
+    results = list(update.iter_updates([path], update.Options(count_received=True)))
+    group, repo = results
+    assert isinstance(group, update.GroupResult)
+    assert (group.status, group.count) == ("ok", 1)
+    assert (repo.name, repo.status) == ("clone", "ok")
+    assert [remote.name for remote in repo.remotes] == ["origin"]
+    assert repo.remotes[0].updated
+    assert repo.remotes[0].objects == 1  # Only the commit; its tree is unchanged
+    assert repo.remotes[0].bytes > 0
+    assert [branch.status for branch in repo.branches] == ["done"]
+
+
+def test_aiter_updates(tmpdir):
+    path = _make_repos(tmpdir)
+
+    async def collect():
+        options = update.Options(fetch_only=True)
+        return [result async for result in update.aiter_updates([path], options)]
+
+    group, repo = asyncio.run(collect())
+    assert repo.status == "ok"
+    assert not repo.branches
+
+
+def test_branch_state_reused(tmpdir, monkeypatch):
+    path = _make_repos(tmpdir)
+    list(update.iter_updates([path]))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("branch should not have been re-evaluated")
+
+    monkeypatch.setattr(update, "_fast_forward", fail)
+    _, repo = update.iter_updates([path])
+    assert [branch.status for branch in repo.branches] == ["up to date"]
+
+
+def test_throttle_pauses_after_budget(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(update.time, "monotonic", lambda: now[0])
+
+    def sleep(delay):
+        sleeps.append(delay)
+        now[0] += delay
+
+    sleeps = []
+    monkeypatch.setattr(update.time, "sleep", sleep)
+
+    throttle = update.Throttle(1000)
+    throttle.wait()
+    throttle.charge(3000)
+    throttle.wait()
+    assert sleeps == [2.0]
+    update.Throttle(None).wait()
+
+
+def test_deprecated_functions(tmpdir, capsys):
+    path = _make_repos(tmpdir)
+    args = argparse.Namespace(
+        max_depth=3, current_only=False, fetch_only=False, prune=False
+    )
+    with pytest.deprecated_call():
+        update.update_directories([path], args)
+    out = capsys.readouterr().out
+    assert "clone:" in out
+    assert "Updating" in out
+
+
+def test_progress_events(tmpdir):
+    path = _make_repos(tmpdir)
+    events = []
+
+    class Recorder(update.Progress):
+        def repo_started(self, name, path):
+            events.append(("repo", name))
+
+        def fetch_started(self, name):
+            events.append(("fetch", name))
+
+        def fetch_finished(self, result):
+            events.append(("fetched", result.name))
+
+        def branch_finished(self, result):
+            events.append(("branch", result.status))
+
+    options = update.Options(progress=Recorder())
+    for result in update.iter_updates([path], options):
+        events.append(type(result).__name__)
+    assert events == [
+        "GroupResult",
+        ("repo", "clone"),
+        ("fetch", "origin"),
+        ("fetched", "origin"),
+        ("branch", "done"),
+        "RepoResult",
+    ]
+
+
+def test_iter_commands(tmpdir):
+    path = _make_repos(tmpdir)
+    with pytest.raises(ValueError):
+        update.iter_commands([path])
+    _, repo = update.iter_commands([path], update.Options(command="git status -s"))
+    assert (repo.status, repo.output) == ("ok", [])
+
+
+def test_branch_state_ignores_working_tree_failures(tmpdir):
+    path = _make_repos(tmpdir)
+    upstream = Repo(str(tmpdir / "upstream"))
+    (tmpdir / "upstream" / "b").write("upstream")
+    upstream.index.add(["b"])
+    upstream.index.commit("third")
+    untracked = tmpdir / "repos" / "clone" / "b"
+    untracked.write("local")
+
+    _, repo = update.iter_updates([path])
+    assert [branch.status for branch in repo.branches] == ["skipped"]
+    untracked.remove()
+    _, repo = update.iter_updates([path])
+    assert [branch.status for branch in repo.branches] == ["done"]
+
+
+def _make_superprojects(tmpdir):
+    _make_repos(tmpdir)
+    url = str(tmpdir / "upstream")
+    origin = Repo.init(str(tmpdir / "super"))
+    with origin.config_writer() as writer:
+        writer.set_value("user", "name", "gitup")
+        writer.set_value("user", "email", "gitup@example.com")
+    origin.git(c="protocol.file.allow=always").submodule("add", url, "sub")
+    origin.index.commit("add submodule")
+    for name in ("a", "b"):
+        clone = origin.clone(str(tmpdir / "supers" / name))
+        clone.git(c="protocol.file.allow=always").submodule("update", "--init")
+    Repo(url).index.commit("third")
+    return str(tmpdir / "supers")
+
+
+def test_submodules_fetched_once(tmpdir):
+    path = _make_superprojects(tmpdir)
+    options = update.Options(submodules=True)
+    _, first, second = update.iter_updates([path], options)
+    (module1,) = first.submodules
+    (module2,) = second.submodules
+    assert (module1.status, module1.remotes[0].source) == ("ok", None)
+    assert module1.remotes[0].updated
+    assert (module2.status, module2.remotes[0].source) == ("ok", module1.path)
+    assert Repo(module2.path).remotes.origin.refs[0].commit.message == "third"
+
+
+def test_submodules_fetched_again_by_later_calls(tmpdir):
+    path = _make_superprojects(tmpdir)
+    options = update.Options(submodules=True)
+    list(update.iter_updates([path], options))
+    Repo(str(tmpdir / "upstream")).index.commit("fourth")
+    _, first, _ = update.iter_updates([path], options)
+    (module,) = first.submodules
+    assert module.remotes[0].source is None
+    assert Repo(module.path).remotes.origin.refs[0].commit.message == "fourth"
+
+
+def test_submodules_network_fallback(tmpdir, monkeypatch):
+    path = _make_superprojects(tmpdir)
+    fetch_remotes = update._fetch_remotes
+    failed = []
+
+    def fail_first_submodule(remotes, *args):
+        if remotes[0].repo.working_dir.endswith("sub") and not failed:
+            failed.append(remotes[0].repo.working_dir)
+            return [update.RemoteResult("origin", "error", "network down.")]
+        return fetch_remotes(remotes, *args)
+
+    # The first checkout's fetch fails, so the second can't share it:
+    monkeypatch.setattr(update, "_fetch_remotes", fail_first_submodule)
+    options = update.Options(submodules=True)
+    _, first, second = update.iter_updates([path], options)
+    assert first.submodules[0].status == "error"
+    assert second.submodules[0].status == "ok"
+    assert second.submodules[0].remotes[0].source is None
+
+    # Fetching from the first checkout fails, so the second uses the network:
+    monkeypatch.setattr(update, "_fetch_remotes", fetch_remotes)
+    monkeypatch.setattr(
+        update,
+        "_fetch_shared",
+        lambda repo, source, prune: update.RemoteResult(
+            "origin", "error", source=source
+        ),
+    )
+    _, first, second = update.iter_updates([path], options)
+    assert first.submodules[0].remotes[0].source is None
+    assert second.submodules[0].status == "ok"
+    assert second.submodules[0].remotes[0].source is None
+
+
+def test_throttle_shared_across_calls(tmpdir, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(update.time, "monotonic", lambda: now[0])
+
+    def sleep(delay):
+        sleeps.append(delay)
+        now[0] += delay
+
+    sleeps = []
+    monkeypatch.setattr(update.time, "sleep", sleep)
+
+    path = _make_repos(tmpdir)
+    options = update.Options(fetch_only=True)
+    throttle = update.Throttle(10)
+    _, repo = update.iter_updates([path], options, throttle)
+    assert not sleeps
+    # The second call still owes for the small fetch made by the first:
+    list(update.iter_updates([path], options, throttle))
+    assert sleeps and sum(sleeps) >= (repo.remotes[0].bytes - 10) / 10
+
+
+def test_shards_ignore_os(monkeypatch):
+    expected = [update._in_shard("Team/Repo{0}".format(i), (1, 3)) for i in range(30)]
+    monkeypatch.setattr(update.os.path, "sep", "\\")
+    names = ["Team\\Repo{0}".format(i) for i in range(30)]
+    assert [update._in_shard(name, (1, 3)) for name in names] == expected
+
+
+def test_auto_gc_deferred_to_maintenance(tmpdir, monkeypatch):
+    path = _make_repos(tmpdir)
+    calls = []
+    monkeypatch.setattr(update, "_auto_gc", lambda repo, options: calls.append(options))
+    list(update.iter_updates([path]))
+    list(update.iter_updates([path], update.Options(maintain=True)))
+    assert [options.maintain for options in calls] == [False, True]
+
+    clone = str(tmpdir / "repos" / "clone")
+    (result,) = update.iter_maintenance([clone])
+    assert (result.path, result.status) == (clone, "ok")
+    objects = tmpdir / "repos" / "clone" / ".git" / "objects"
+    assert (objects / "info" / "commit-graph").exists() or (
+        objects / "info" / "commit-graphs"
+    ).exists()
+    assert (objects / "pack" / "multi-pack-index").exists()
+
+
+@pytest.mark.skipif(not hasattr(os, "nice"), reason="needs os.nice()")
+def test_lower_priority():
+    code = (
+        "from gitup.update import lower_priority; lower_priority(); print(os.nice(0))"
+    )
+    output = subprocess.check_output([sys.executable, "-c", "import os; " + code])
+    assert int(output) == 19
+
+
+def test_submodules_prune_keeps_local_tags(tmpdir):
+    path = _make_superprojects(tmpdir)
+    sub = Repo(str(tmpdir / "supers" / "b" / "sub"))
+    sub.create_tag("mylocal")
+    options = update.Options(submodules=True, prune=True)
+    _, first, second = update.iter_updates([path], options)
+    assert second.submodules[0].remotes[0].source == first.submodules[0].path
+    assert second.submodules[0].status == "ok"
+    assert "mylocal" in [tag.name for tag in sub.tags]
+
+
+def test_small_fetches_unpacked_by_default(tmpdir):
+    path = _make_repos(tmpdir)
+    packs = tmpdir / "repos" / "clone" / ".git" / "objects" / "pack"
+    before = packs.listdir("*.pack")
+    _, repo = update.iter_updates([path], update.Options(fetch_only=True))
+    assert repo.remotes[0].updated
+    assert repo.remotes[0].bytes == 0
+    assert packs.listdir("*.pack") == before
@@ -2,64 +2,346 @@
 #
 # Copyright (C) 2011-2018 Ben Kurtovic <ben.kurtovic@gmail.com>
 # Released under the terms of the MIT License. See LICENSE for details.
-import logging
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
+from functools import partial
 from glob import glob
+from hashlib import sha1
+import logging
 import os
 import re
 import shlex
+import shutil
+import subprocess
+import threading
+import time
+import warnings
 
-from colorama import Fore, Style
 from git import RemoteReference as RemoteRef, Repo, exc
 from git.util import RemoteProgress
 
+from gitup.journal import Journal
+
 logger = logging.getLogger(__name__)
 
-__all__ = ["update_bookmarks", "update_directories", "run_command"]
+__all__ = [
+    "Options",
+    "Progress",
+    "Throttle",
+    "GroupResult",
+    "RepoResult",
+    "RemoteResult",
+    "BranchResult",
+    "iter_updates",
+    "iter_commands",
+    "iter_maintenance",
+    "aiter_updates",
+    "aiter_commands",
+    "lower_priority",
+    "update_bookmarks",
+    "update_directories",
+    "run_command",
+]
+
+# Where the outcome of the last update of each branch is recorded, inside the
+# git directory of each repo:
+STATE_FILE = "gitup-branches"
+
+# Marks the start of a version 2 (or later) pack index:
+PACK_INDEX_MAGIC = b"\377tOc"
+
+
+@dataclass(slots=True)
+class Options:
+    """Options controlling how repos are found and updated.
+
+    These mirror the command-line arguments of the same names, except
+    *count_received*: if set, fetches always keep what they receive as a pack
+    (instead of unpacking small ones), so that RemoteResult.objects and .bytes
+    are accurate even for small fetches, at the cost of leaving more packs for
+    gc to consolidate. Otherwise, only fetches large enough to be kept as a
+    pack are counted.
+    """
+
+    max_depth: int = 3
+    current_only: bool = False
+    fetch_only: bool = False
+    prune: bool = False
+    command: str | None = None
+    shard: tuple[int, int] | None = None
+    submodules: bool = False
+    maintain: bool = False
+    count_received: bool = False
+    jobs: int = 4
+    bandwidth: int | None = None
+    journal: "Journal | None" = None
+    progress: "Progress | None" = None
+
+
+class Progress:
+    """Receives events as repos are updated, for showing output live.
+
+    Set *Options.progress* to an instance of a subclass overriding any of these
+    methods, which do nothing by default. Events are reported in order for each
+    top-level repo (fetch progress may come from a different thread, while the
+    fetch is running); submodules, which are updated concurrently, are only
+    reported once each has finished.
+    """
 
-BOLD = Style.BRIGHT
-BLUE = Fore.BLUE + BOLD
-GREEN = Fore.GREEN + BOLD
-RED = Fore.RED + BOLD
-CYAN = Fore.CYAN + BOLD
-YELLOW = Fore.YELLOW + BOLD
-RESET = Style.RESET_ALL
+    def repo_started(self, name, path):
+        """Called before a repo is updated."""
 
-INDENT1 = " " * 3
-INDENT2 = " " * 7
-ERROR = RED + "Error:" + RESET
+    def fetch_started(self, name):
+        """Called before the remote with the given name is fetched."""
+
+    def fetch_progress(self, name, counts):
+        """Called as a fetch progresses, with the counts so far.
+
+        *counts* is a list of ``(count, total)`` tuples for each compressing
+        and receiving stage, as in RemoteResult.counts.
+        """
+
+    def fetch_finished(self, result):
+        """Called with the RemoteResult of each remote, even if skipped."""
+
+    def branch_finished(self, result):
+        """Called with the BranchResult of each branch."""
+
+    def submodule_finished(self, result):
+        """Called with the RepoResult of each submodule."""
+
+
+@dataclass(slots=True)
+class GroupResult:
+    """The outcome of looking for repos in a single given path.
+
+    *status* is ``"ok"`` (*count* repos were found), ``"error"`` (the path
+    isn't usable; see *message*), or ``"comment"`` (a bookmark comment).
+    """
+
+    path: str
+    status: str = "ok"
+    message: str | None = None
+    count: int = 0
+    shard: tuple[int, int] | None = None
+
+
+@dataclass(slots=True)
+class BranchResult:
+    """The outcome of fast-forwarding a single local branch.
+
+    *status* is ``"done"``, ``"up to date"``, or ``"skipped"`` (see *message*).
+    """
+
+    name: str
+    status: str
+    message: str | None = None
+
+
+@dataclass(slots=True)
+class RemoteResult:
+    """The outcome of fetching a single remote.
+
+    *status* is ``"ok"``, ``"skipped"``, or ``"error"`` (see *message*). The
+    names of new branches, new tags, and updated branches are listed, along
+    with the final ``(count, total)`` of each compressing/receiving stage, the
+    number of objects and bytes received (as stored in the pack written by the
+    fetch), and how long the fetch took. If the remote was fetched from another
+    local repo with the same URL instead of over the network, *source* is that
+    repo's path.
+    """
+
+    name: str
+    status: str = "ok"
+    message: str | None = None
+    source: str | None = None
+    new_heads: list[str] = field(default_factory=list)
+    new_tags: list[str] = field(default_factory=list)
+    updated: list[str] = field(default_factory=list)
+    counts: list[tuple[int, int | None]] = field(default_factory=list)
+    objects: int = 0
+    bytes: int = 0
+    duration: float = 0.0
+
+
+@dataclass(slots=True)
+class RepoResult:
+    """The outcome of updating (or running a command on) a single repo.
+
+    *status* is ``"ok"``, ``"error"``, or ``"resumed"`` (the repo was already
+    done by an interrupted run). *message* describes repo-level errors, and
+    *output* holds the lines printed by a command. Submodules updated along
+    with the repo have their own nested results.
+    """
+
+    name: str
+    path: str
+    status: str = "ok"
+    message: str | None = None
+    remotes: list[RemoteResult] = field(default_factory=list)
+    branches: list[BranchResult] = field(default_factory=list)
+    output: list[str] = field(default_factory=list)
+    submodules: list["RepoResult"] = field(default_factory=list)
 
 
 class _ProgressMonitor(RemoteProgress):
-    """Displays relevant output during the fetching process."""
+    """Records relevant progress counts during the fetching process."""
 
-    def __init__(self):
+    def __init__(self, name, progress):
         super(_ProgressMonitor, self).__init__()
-        self._started = False
+        self._name = name
+        self._progress = progress
+        self.counts = []
 
     def update(self, op_code, cur_count, max_count=None, message=""):
         """Called whenever progress changes. Overrides default behavior."""
         if op_code & (self.COMPRESSING | self.RECEIVING):
-            cur_count = str(int(cur_count))
-            if max_count:
-                max_count = str(int(max_count))
-            if op_code & self.BEGIN:
-                print("\b, " if self._started else " (", end="")
-                if not self._started:
-                    self._started = True
-            if op_code & self.END:
-                end = ")"
-            elif max_count:
-                end = "\b" * (1 + len(cur_count) + len(max_count))
-            else:
-                end = "\b" * len(cur_count)
-            if max_count:
-                print("{0}/{1}".format(cur_count, max_count), end=end)
+            count = (int(cur_count), int(max_count) if max_count else None)
+            if op_code & self.BEGIN or not self.counts:
+                self.counts.append(count)
             else:
-                print(str(cur_count), end=end)
+                self.counts[-1] = count
+            self._progress.fetch_progress(self._name, list(self.counts))
+
+
+def _format_error(err):
+    """Return a readable one-line message for a GitCommandError."""
+    # We should have to do this ourselves, but GitPython doesn't give us a
+    # sensible way to get the raw stderr...
+    msg = re.sub(r"\s+", " ", err.stderr).strip()
+    msg = re.sub(r"^stderr: *'(fatal: *)?", "", msg).strip("'")
+    if not msg:
+        command = " ".join(shlex.quote(str(arg)) for arg in err.command)
+        msg = "{0} failed with status {1}.".format(command, err.status)
+    elif not msg.endswith("."):
+        msg += "."
+    return msg
+
+
+def lower_priority():
+    """Lower the CPU and IO priority of this process and its children.
+
+    Every git subprocess started afterwards (fetches and the index-pack work
+    they trigger, merges, commands, maintenance) inherits the lower priority.
+    This can't be undone, so it should only be called once nothing
+    latency-sensitive is left to do. Unsupported platforms are ignored.
+    """
+    if hasattr(os, "nice"):
+        os.nice(19)
+        if shutil.which("ionice"):
+            cmd = ["ionice", "-c", "2", "-n", "7", "-p", str(os.getpid())]
+            subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elif os.name == "nt":
+        import ctypes
+
+        kernel32 = ctypes.windll.kernel32
+        idle_priority_class = 0x40
+        kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), idle_priority_class)
+
+
+class Throttle:
+    """Limits the rate of data received by all fetches in a run.
+
+    This is a token bucket holding up to one second's worth of bytes (*rate*
+    bytes per second; ``None`` means no limit). Since a fetch can't be slowed
+    down once it has started, each fetch is charged for what it received
+    afterwards, and new fetches wait (in any thread) until the bucket is no
+    longer in debt. Pass the same instance to several iter_updates() calls to
+    give them one shared budget.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tokens = rate or 0
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        """Add tokens for the time passed since the last refill."""
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
 
+    def wait(self):
+        """Block until the budget allows another fetch to start."""
+        while self.rate:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 0:
+                    return
+                delay = -self._tokens / self.rate
+            time.sleep(delay)
 
-def _fetch_remotes(remotes, prune):
-    """Fetch a list of remotes, displaying progress info along the way."""
+    def charge(self, count):
+        """Deduct the given number of bytes received from the budget."""
+        if self.rate:
+            with self._lock:
+                self._refill()
+                self._tokens -= count
+
+
+def _list_packs(repo):
+    """Return the set of pack files in a repo's object directory."""
+    pack_dir = os.path.join(repo.common_dir, "objects", "pack")
+    try:
+        names = os.listdir(pack_dir)
+    except OSError:
+        return set()
+    return {os.path.join(pack_dir, name) for name in names if name.endswith(".pack")}
+
+
+def _count_received(repo, old_packs):
+    """Return the number of objects and bytes in packs added to a repo.
+
+    *old_packs* is the result of _list_packs() from before the fetch. The
+    object count of each new pack is read from the header of its index.
+    """
+    objects = size = 0
+    for pack in _list_packs(repo) - old_packs:
+        try:
+            size += os.path.getsize(pack)
+            with open(pack[: -len(".pack")] + ".idx", "rb") as handle:
+                header = handle.read(8 + 256 * 4)
+        except OSError as err:
+            logger.debug(err)
+            continue
+        if header.startswith(PACK_INDEX_MAGIC):
+            header = header[8:]
+        if len(header) >= 256 * 4:  # The last fanout entry is the total
+            objects += int.from_bytes(header[255 * 4 : 256 * 4], "big")
+    return objects, size
+
+
+def _keep_pack_env(keep_pack=True):
+    """Return environment variables making fetches always keep a pack.
+
+    git normally explodes small fetches into loose objects, leaving no record
+    of how much was received; this sets fetch.unpackLimit to 1 on top of any
+    configuration already passed through the environment. If *keep_pack* is
+    False, nothing is changed.
+    """
+    if not keep_pack:
+        return {}
+    count = int(os.environ.get("GIT_CONFIG_COUNT") or 0)
+    return {
+        "GIT_CONFIG_COUNT": str(count + 1),
+        "GIT_CONFIG_KEY_{0}".format(count): "fetch.unpackLimit",
+        "GIT_CONFIG_VALUE_{0}".format(count): "1",
+    }
+
+
+def _fetch_remotes(remotes, prune, throttle=None, progress=None, count=False):
+    """Fetch a list of remotes, returning a list of RemoteResults.
+
+    Remotes after the first one that fails to fetch are not attempted. If a
+    *throttle* is given, each fetch waits for its bandwidth budget first.
+    Events are reported to *progress*, if given. If *count* is True, or the
+    throttle has a limit, every fetch keeps a pack so that what it received
+    can be counted exactly.
+    """
+    progress = progress or Progress()
+    keep_pack = count or bool(throttle and throttle.rate)
 
     def _get_name(ref):
         """Return the local name of a remote or tag reference."""
@@ -67,93 +349,128 @@ def _fetch_remotes(remotes, prune):
 
     # TODO: missing branch deleted (via --prune):
     info = [
-        ("NEW_HEAD", "new branch", "new branches"),
-        ("NEW_TAG", "new tag", "new tags"),
-        ("FAST_FORWARD", "branch update", "branch updates"),
+        ("NEW_HEAD", "new_heads"),
+        ("NEW_TAG", "new_tags"),
+        ("FAST_FORWARD", "updated"),
     ]
-    up_to_date = BLUE + "up to date" + RESET
 
+    results = []
     for remote in remotes:
-        print(INDENT2, "Fetching", BOLD + remote.name, end="")
+        result = RemoteResult(remote.name)
+        results.append(result)
 
         if not remote.config_reader.has_option("fetch"):
-            print(":", YELLOW + "skipped:", "no configured refspec.")
+            result.status = "skipped"
+            result.message = "no configured refspec."
+            progress.fetch_finished(result)
             continue
 
+        monitor = _ProgressMonitor(remote.name, progress)
+        if throttle:
+            throttle.wait()
+        progress.fetch_started(remote.name)
+        packs = _list_packs(remote.repo)
+        start = time.monotonic()
         try:
-            results = remote.fetch(progress=_ProgressMonitor(), prune=prune)
+            # Auto-gc runs once per repo afterwards (see _auto_gc()), since it
+            # stalls fetches at random points and confuses GitPython's output
+            # parsing:
+            with remote.repo.git.custom_environment(**_keep_pack_env(keep_pack)):
+                fetched = remote.fetch(progress=monitor, prune=prune, no_auto_gc=True)
         except exc.GitCommandError as err:
-            # We should have to do this ourselves, but GitPython doesn't give
-            # us a sensible way to get the raw stderr...
-            msg = re.sub(r"\s+", " ", err.stderr).strip()
-            msg = re.sub(r"^stderr: *'(fatal: *)?", "", msg).strip("'")
-            if not msg:
-                command = " ".join(shlex.quote(arg) for arg in err.command)
-                msg = "{0} failed with status {1}.".format(command, err.status)
-            elif not msg.endswith("."):
-                msg += "."
-            print(":", RED + "error:", msg)
-            return
+            result.status = "error"
+            result.message = _format_error(err)
+            progress.fetch_finished(result)
+            break
         except AssertionError:  # Seems to be the result of a bug in GitPython
-            # This happens when git initiates an auto-gc during fetch:
-            print(
-                ":",
-                RED + "error:",
-                "something went wrong in GitPython,",
-                "but the fetch might have been successful.",
+            # This used to happen when git initiated an auto-gc during fetch:
+            result.status = "error"
+            result.message = (
+                "something went wrong in GitPython, "
+                "but the fetch might have been successful."
             )
-            return
-        rlist = []
-        for attr, singular, plural in info:
+            progress.fetch_finished(result)
+            break
+        finally:
+            result.duration = time.monotonic() - start
+            result.counts = monitor.counts
+            result.objects, result.bytes = _count_received(remote.repo, packs)
+            if throttle:
+                throttle.charge(result.bytes)
+        for flag, attr in info:
             names = [
-                _get_name(res.ref) for res in results if res.flags & getattr(res, attr)
+                _get_name(res.ref) for res in fetched if res.flags & getattr(res, flag)
             ]
-            if names:
-                desc = singular if len(names) == 1 else plural
-                colored = GREEN + desc + RESET
-                rlist.append("{0} ({1})".format(colored, ", ".join(names)))
-        print(":", (", ".join(rlist) if rlist else up_to_date) + ".")
+            setattr(result, attr, names)
+        progress.fetch_finished(result)
+    return results
 
 
-def _update_branch(repo, branch, is_active=False):
-    """Update a single branch."""
-    print(INDENT2, "Updating", BOLD + branch.name, end=": ")
-    upstream = branch.tracking_branch()
-    if not upstream:
-        print(YELLOW + "skipped:", "no upstream is tracked.")
-        return
+def _load_branch_state(repo):
+    """Return the recorded outcome of the last update of each local branch.
+
+    The record maps branch names to ``(commit, upstream commit, status,
+    message)`` tuples, and lives in the repo's git directory.
+    """
+    path = os.path.join(repo.git_dir, STATE_FILE)
     try:
-        branch.commit
-    except ValueError:
-        print(YELLOW + "skipped:", "branch has no revisions.")
-        return
+        with open(path, "rb") as handle:
+            lines = handle.read().decode("utf8").splitlines()
+    except IOError:
+        return {}
+
+    state = {}
+    for line in lines:
+        parts = line.split("\t")
+        if len(parts) == 5:
+            name, commit, upstream, status, message = parts
+            state[name] = (commit, upstream, status, message or None)
+    return state
+
+
+def _save_branch_state(repo, state):
+    """Save the outcome of updating each local branch; see above."""
+    path = os.path.join(repo.git_dir, STATE_FILE)
+    lines = [
+        "\t".join((name, commit, upstream, status, message or ""))
+        for name, (commit, upstream, status, message) in sorted(state.items())
+    ]
     try:
-        upstream.commit
-    except ValueError:
-        print(YELLOW + "skipped:", "upstream does not exist.")
-        return
+        with open(path, "wb") as handle:
+            handle.write("".join(line + "\n" for line in lines).encode("utf8"))
+    except IOError as err:
+        logger.debug(err)
+
 
+def _fast_forward(repo, branch, upstream, result, is_active=False):
+    """Fast-forward a branch to its upstream if possible, updating a result.
+
+    Return whether the outcome depends only on the commits of the branch and
+    its upstream, rather than on the state of the working tree.
+    """
     try:
         base = repo.git.merge_base(branch.commit, upstream.commit)
     except exc.GitCommandError as err:
         logger.debug(err)
-        print(YELLOW + "skipped:", "can't find merge base with upstream.")
-        return
+        result.message = "can't find merge base with upstream."
+        return True
 
     if repo.commit(base) == upstream.commit:
-        print(BLUE + "up to date", end=".\n")
-        return
+        result.status = "up to date"
+        return True
 
     if is_active:
         try:
             repo.git.merge(upstream.name, ff_only=True)
-            print(GREEN + "done", end=".\n")
+            result.status = "done"
         except exc.GitCommandError as err:
             msg = err.stderr
             if "local changes" in msg and "would be overwritten" in msg:
-                print(YELLOW + "skipped:", "uncommitted changes.")
+                result.message = "uncommitted changes."
             else:
-                print(YELLOW + "skipped:", "not possible to fast-forward.")
+                result.message = "not possible to fast-forward."
+        # Merges can fail because of local changes or untracked files:
+        return result.status == "done"
     else:
         status = repo.git.merge_base(
             branch.commit,
@@ -163,78 +480,307 @@ def _update_branch(repo, branch, is_active=False):
             with_exceptions=False,
         )[0]
         if status != 0:
-            print(YELLOW + "skipped:", "not possible to fast-forward.")
+            result.message = "not possible to fast-forward."
         else:
             repo.git.branch(branch.name, upstream.name, force=True)
-            print(GREEN + "done", end=".\n")
+            result.status = "done"
+        return True
+
+
+def _update_branch(repo, branch, is_active=False, state=None):
+    """Update a single branch, returning a BranchResult.
+
+    If a *state* record (see _load_branch_state()) is given, and neither the
+    branch nor its upstream has moved since the recorded outcome, that outcome
+    is reused without running git at all; otherwise, the record is updated.
+    Failed merges into the active branch are never recorded, since they may
+    depend on the working tree.
+    """
+    result = BranchResult(branch.name, "skipped")
+    upstream = branch.tracking_branch()
+    if not upstream:
+        result.message = "no upstream is tracked."
+        return result
+    try:
+        branch.commit
+    except ValueError:
+        result.message = "branch has no revisions."
+        return result
+    try:
+        upstream.commit
+    except ValueError:
+        result.message = "upstream does not exist."
+        return result
 
+    if state is None:
+        state = {}
+    key = (branch.commit.hexsha, upstream.commit.hexsha)
+    recorded = state.get(branch.name)
+    if recorded and recorded[:2] == key:
+        result.status, result.message = recorded[2:]
+        return result
 
-def _update_repository(repo, repo_name, args):
+    cacheable = _fast_forward(repo, branch, upstream, result, is_active)
+    if result.status == "done":
+        state[branch.name] = (key[1], key[1], "up to date", None)
+    elif not cacheable:
+        state.pop(branch.name, None)
+    else:
+        state[branch.name] = key + (result.status, result.message)
+    return result
+
+
+def _update_branches(repo, result, progress=None):
+    """Update all local branches of a repo, adding them to its RepoResult.
+
+    Each BranchResult is also reported to *progress*, if given.
+    """
+    progress = progress or Progress()
+    try:
+        active = repo.active_branch
+    except TypeError:  # Happens when HEAD is detached
+        active = None
+
+    old_state = _load_branch_state(repo)
+    state = old_state.copy()
+    heads = sorted(repo.heads, key=lambda b: b.name)
+    for branch in heads:
+        branch_result = _update_branch(repo, branch, branch == active, state)
+        result.branches.append(branch_result)
+        progress.branch_finished(branch_result)
+    state = {head.name: state[head.name] for head in heads if head.name in state}
+    if state != old_state:
+        _save_branch_state(repo, state)
+
+
+def _auto_gc(repo, options):
+    """Run git's automatic garbage collection, which fetches skip.
+
+    This is left to the --maintain phase instead if *options.maintain* is set.
+    """
+    if options.maintain:
+        return
+    try:
+        repo.git.gc(auto=True, quiet=True)
+    except exc.GitCommandError as err:
+        logger.debug(err)
+
+
+def _fetch_shared(repo, source, prune):
+    """Fetch a submodule's origin from another checkout of the same URL.
+
+    This updates the remote-tracking branches and tags of *repo* from those of
+    the repo at *source*, which has already been fetched, without going over
+    the network again. Return a RemoteResult.
+    """
+    result = RemoteResult("origin", source=source)
+    start = time.monotonic()
+    branches = "+refs/remotes/origin/*:refs/remotes/origin/*"
+    tags = "refs/tags/*:refs/tags/*"
+    try:
+        if prune:
+            # Pruning would delete local-only tags too, which a normal fetch
+            # never does, so tags are fetched separately:
+            repo.git.fetch(source, branches, prune=True, no_auto_gc=True)
+            repo.git.fetch(source, tags, no_auto_gc=True)
+        else:
+            repo.git.fetch(source, branches, tags, no_auto_gc=True)
+    except exc.GitCommandError as err:
+        result.status = "error"
+        result.message = _format_error(err)
+    result.duration = time.monotonic() - start
+    return result
+
+
+def _update_submodule(path, name, options, sources, throttle=None):
+    """Update a single submodule checkout, returning a RepoResult.
+
+    If *sources* is empty, the submodule is fetched from its remotes as usual;
+    otherwise, it is fetched from the first of the given submodule paths, or
+    from its remotes if that fails.
+    """
+    repo = Repo(path)
+    if sources:
+        remote = _fetch_shared(repo, sources[0], options.prune)
+        if remote.status == "ok":
+            result = RepoResult(name, path, remotes=[remote])
+            if not options.fetch_only:
+                _update_branches(repo, result)
+            _auto_gc(repo, options)
+            return result
+        logger.debug("can't fetch %s from %s: %s", path, sources[0], remote.message)
+
+    options = replace(options, current_only=False, submodules=False, progress=None)
+    return _update_repository(repo, name, options, throttle=throttle)
+
+
+def _update_submodules(repo, options, fetched, throttle=None):
+    """Update the initialized submodules of a repo concurrently.
+
+    Up to *options.jobs* submodules are updated at once. Submodules that share
+    a URL (within this repo, or with one updated earlier in the run, according
+    to the *fetched* dict of URLs to submodule paths) are only fetched over the
+    network once; the others are fetched from that copy (or from the network,
+    if that fails). Return a list of
+    RepoResults, after reporting each to *options.progress* as it finishes.
+    """
+    progress = options.progress or Progress()
+    groups = {}
+    for module in repo.submodules:
+        try:
+            if not module.module_exists():
+                continue
+            remotes = module.module().remotes
+            url = remotes.origin.url if "origin" in remotes else module.url
+        except (ValueError, exc.InvalidGitRepositoryError) as err:
+            logger.debug(err)
+            continue
+        url = url.rstrip("/")
+        url = url[:-4] if url.endswith(".git") else url
+        groups.setdefault(url, []).append(module)
+
+    def _update_group(modules, sources):
+        """Update submodules with the same URL one after another."""
+        results = []
+        for module in modules:
+            result = _update_submodule(
+                module.abspath, module.path, options, sources, throttle
+            )
+            results.append(result)
+            if result.status == "ok" and not result.remotes[0].source:
+                sources = [module.abspath]  # Fetched over the network
+        return results
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(options.jobs, 1)) as executor:
+        futures = {
+            executor.submit(_update_group, modules, fetched.get(url, [])[:1]): url
+            for url, modules in groups.items()
+        }
+        for future in as_completed(futures):
+            group = future.result()
+            paths = [result.path for result in group if result.status == "ok"]
+            fetched.setdefault(futures[future], []).extend(paths)
+            for result in group:
+                progress.submodule_finished(result)
+            results += group
+    return sorted(results, key=lambda result: result.name)
+
+
+def _update_repository(repo, repo_name, options, fetched=None, throttle=None):
     """Update a single git repository by fetching remotes and rebasing/merging.
 
-    The specific actions depend on the arguments given. We will fetch all
-    remotes if *args.current_only* is ``False``, or only the remote tracked by
-    the current branch if ``True``. If *args.fetch_only* is ``False``, we will
-    also update all fast-forwardable branches that are tracking valid
-    upstreams. If *args.prune* is ``True``, remote-tracking branches that no
-    longer exist on their remote after fetching will be deleted.
+    The specific actions depend on the options given. We will fetch all
+    remotes if *options.current_only* is ``False``, or only the remote tracked
+    by the current branch if ``True``. If *options.fetch_only* is ``False``, we
+    will also update all fast-forwardable branches that are tracking valid
+    upstreams. If *options.prune* is ``True``, remote-tracking branches that no
+    longer exist on their remote after fetching will be deleted. Unless
+    *options.maintain* is ``True`` (meaning iter_maintenance() will be run
+    afterwards), git's auto-gc is run once everything is fetched. If
+    *options.submodules* is ``True``, initialized submodules are updated too;
+    *fetched* tracks submodule URLs already fetched during the run, and
+    *throttle* (if given) enforces the run's bandwidth budget. Each step is
+    reported to *options.progress*, if set.
+
+    Return a RepoResult.
     """
-    print(INDENT1, BOLD + repo_name + ":")
+    progress = options.progress or Progress()
+    progress.repo_started(repo_name, repo.working_dir)
+    result = RepoResult(repo_name, repo.working_dir, "error")
 
     try:
         active = repo.active_branch
     except TypeError:  # Happens when HEAD is detached
         active = None
-    if args.current_only:
+    if options.current_only:
         if not active:
-            print(
-                INDENT2,
-                ERROR,
-                "--current-only doesn't make sense with a detached HEAD.",
-            )
-            return
+            result.message = "--current-only doesn't make sense with a detached HEAD."
+            return result
         ref = active.tracking_branch()
         if not ref:
-            print(INDENT2, ERROR, "no remote tracked by current branch.")
-            return
+            result.message = "no remote tracked by current branch."
+            return result
         remotes = [repo.remotes[ref.remote_name]]
     else:
         remotes = repo.remotes
 
     if not remotes:
-        print(INDENT2, ERROR, "no remotes configured to fetch.")
-        return
-    _fetch_remotes(remotes, args.prune)
+        result.message = "no remotes configured to fetch."
+        return result
+    result.remotes = _fetch_remotes(
+        remotes, options.prune, throttle, progress, options.count_received
+    )
+
+    if not options.fetch_only:
+        _update_branches(repo, result, progress)
+    _auto_gc(repo, options)
+    if options.submodules:
+        fetched = {} if fetched is None else fetched
+        result.submodules = _update_submodules(repo, options, fetched, throttle)
+    if all(remote.status != "error" for remote in result.remotes) and all(
+        module.status == "ok" for module in result.submodules
+    ):
+        result.status = "ok"
+    return result
 
-    if not args.fetch_only:
-        for branch in sorted(repo.heads, key=lambda b: b.name):
-            _update_branch(repo, branch, branch == active)
 
+def _run_command(repo, repo_name, options):
+    """Run an arbitrary shell command on the given repository.
 
-def _run_command(repo, repo_name, args):
-    """Run an arbitrary shell command on the given repository."""
-    print(INDENT1, BOLD + repo_name + ":")
+    Return a RepoResult.
+    """
+    result = RepoResult(repo_name, repo.working_dir)
 
-    cmd = shlex.split(args.command)
+    cmd = shlex.split(options.command)
     try:
         out = repo.git.execute(cmd, with_extended_output=True, with_exceptions=False)
     except exc.GitCommandNotFound as err:
-        print(INDENT2, ERROR, err)
-        return
+        result.status = "error"
+        result.message = str(err)
+        return result
+
+    result.output = out[1].splitlines() + out[2].splitlines()
+    if out[0] != 0:
+        result.status = "error"
+    return result
+
 
-    for line in out[1].splitlines() + out[2].splitlines():
-        print(INDENT2, line)
+def _in_shard(name, shard):
+    """Return whether a repo with the given name belongs to the given shard.
+
+    *shard* is an ``(index, count)`` tuple with a 1-based index, or ``None`` to
+    include everything. Assignment depends only on the repo's name relative to
+    its bookmark, so it is stable when other repos are added or removed, and
+    agrees across machines (on any OS) that have the same tree mounted in
+    different places. Names are case-sensitive. A repo reachable from several
+    bookmarks is named after the first one that finds it (see _dispatch()), so
+    machines sharing work should list their bookmarks in the same order.
+    """
+    if not shard:
+        return True
+    index, count = shard
+    key = name.replace(os.path.sep, "/").encode("utf8")
+    return int(sha1(key).hexdigest()[:15], 16) % count == index - 1
 
 
-def _dispatch(base_path, callback, args):
+def _dispatch(base_path, callback, options, seen=None):
     """Apply a callback function on each valid repo in the given path.
 
     Determine whether the directory is a git repo on its own, a directory of
     git repositories, a shell glob pattern, or something invalid. If the first,
     apply the callback on it; if the second or third, apply the callback on all
-    repositories contained within; if the last, print an error.
+    repositories contained within; if the last, report an error.
 
-    The given args are passed directly to the callback function after the repo.
+    This is a generator: it yields a GroupResult describing the path, followed
+    by the RepoResult returned by the callback for each repo.
+
+    The given options are passed directly to the callback function after the
+    repo. Repos whose real paths are already in the *seen* set are skipped, and
+    new ones are added to it; if *options.shard* is set, only repos in that
+    shard are considered. If *options.journal* is set, repos completed by the
+    interrupted run it was resumed from are skipped, and each repo processed
+    now is recorded in it along with the callback's result.
     """
 
     def _collect(paths, max_depth):
@@ -269,7 +815,7 @@ def _dispatch(base_path, callback, args):
         return path.split(prefix + os.path.sep, 1)[1]
 
     base = os.path.expanduser(base_path)
-    max_depth = args.max_depth
+    max_depth = options.max_depth
     if max_depth >= 0:
         max_depth += 1
 
@@ -280,27 +826,67 @@ def _dispatch(base_path, callback, args):
         if is_comment(base):
             comment = get_comment(base)
             if comment:
-                print(CYAN + BOLD + comment)
+                yield GroupResult(base, "comment", comment)
             return
         paths = glob(base)
         if not paths:
-            print(ERROR, BOLD + base, "doesn't exist!")
+            yield GroupResult(base, "error", "doesn't exist!")
             return
         valid = _collect(paths, max_depth)
     except exc.InvalidGitRepositoryError:
-        if not os.path.isdir(base) or args.max_depth == 0:
-            print(ERROR, BOLD + base, "isn't a repository!")
+        if not os.path.isdir(base) or options.max_depth == 0:
+            yield GroupResult(base, "error", "isn't a repository!")
             return
         valid = _collect([base], max_depth)
 
     base = os.path.abspath(base)
-    suffix = "" if len(valid) == 1 else "s"
-    print(BOLD + base, "({0} repo{1}):".format(len(valid), suffix))
-
+    if seen is None:
+        seen = set()
+    shard = options.shard
     valid = [os.path.abspath(path) for path in valid]
-    paths = [(_get_basename(base, path), path) for path in valid]
-    for name, path in sorted(paths):
-        callback(Repo(path), name, args)
+    paths = []
+    for name, path in sorted((_get_basename(base, path), path) for path in valid):
+        real = os.path.normcase(os.path.realpath(path))
+        if real in seen:
+            continue
+        seen.add(real)
+        if _in_shard(name, shard):
+            paths.append((name, path))
+
+    yield GroupResult(base, count=len(paths), shard=shard)
+
+    journal = options.journal
+    for name, path in paths:
+        if journal and journal.is_done(path):
+            yield RepoResult(name, path, "resumed")
+            continue
+        result = callback(Repo(path), name, options)
+        if journal:
+            journal.record(path, result.status)
+        yield result
+
+
+def _maintain_repository(path):
+    """Run background maintenance tasks on the repository at the given path.
+
+    Return a RepoResult.
+    """
+    result = RepoResult(path, path)
+    repo = Repo(path)
+    packs = os.path.join(repo.common_dir, "objects", "pack", "*.pack")
+    try:
+        # This is the auto-gc we suppress during fetches:
+        repo.git.maintenance("run", "--auto", "--quiet", "--task=gc")
+        repo.git.maintenance(
+            "run", "--quiet", "--task=commit-graph", "--task=loose-objects"
+        )
+        # Writes the multi-pack-index, but fails if there are no packs yet:
+        if glob(packs):
+            repo.git.maintenance("run", "--quiet", "--task=incremental-repack")
+    except exc.GitCommandError as err:
+        result.status = "error"
+        result.message = _format_error(err)
+    return result
 
 
 def is_comment(path):
@@ -313,23 +899,130 @@ def get_comment(path):
     return path.lstrip().lstrip("#").strip()
 
 
+def _iter_all(paths, callback, options):
+    """Dispatch a callback over several paths, skipping duplicate repos."""
+    seen = set()
+    for path in paths:
+        yield from _dispatch(path, callback, options, seen)
+
+
+async def _aiter(results):
+    """Drive a blocking results generator from a worker thread."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        result = await loop.run_in_executor(None, next, results, done)
+        if result is done:
+            return
+        yield result
+
+
+def iter_updates(paths, options=None, throttle=None):
+    """Update all repos found in the given paths, yielding results as we go.
+
+    For each path, a GroupResult is yielded, followed by a RepoResult for each
+    repo found in it. If *options.bandwidth* is set, new fetches are paused as
+    needed to keep the data received under that many bytes per second. To
+    share that budget with other calls, pass them all the same *throttle* (a
+    Throttle), which is then used instead.
+    """
+    options = options or Options()
+    throttle = throttle or Throttle(options.bandwidth)
+    update = partial(_update_repository, fetched={}, throttle=throttle)
+    return _iter_all(paths, update, options)
+
+
+def iter_commands(paths, options=None):
+    """Run *options.command* on all repos found in the given paths.
+
+    Results are yielded in the same way as iter_updates(). Raise ValueError
+    if no command is set.
+    """
+    options = options or Options()
+    if not options.command:
+        raise ValueError("options.command must be set to run a command")
+    return _iter_all(paths, _run_command, options)
+
+
+def iter_maintenance(paths, options=None):
+    """Run background maintenance on a list of repo paths.
+
+    Up to *options.jobs* repos are maintained concurrently, and a RepoResult
+    is yielded for each as it finishes. Consider calling lower_priority()
+    first, if nothing else in the process is latency-sensitive.
+    """
+    options = options or Options()
+    with ThreadPoolExecutor(max_workers=max(options.jobs, 1)) as executor:
+        futures = [
+            executor.submit(_maintain_repository, path) for path in sorted(set(paths))
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def aiter_updates(paths, options=None, throttle=None):
+    """Asynchronous version of iter_updates()."""
+    return _aiter(iter_updates(paths, options, throttle))
+
+
+def aiter_commands(paths, options=None):
+    """Asynchronous version of iter_commands()."""
+    return _aiter(iter_commands(paths, options))
+
+
+def _legacy_options(args):
+    """Build Options from the argparse namespace taken by the old functions."""
+    names = ["max_depth", "current_only", "fetch_only", "prune", "command"]
+    return Options(
+        **{name: getattr(args, name) for name in names if hasattr(args, name)}
+    )
+
+
+def _warn_deprecated(name, replacement):
+    """Warn that one of the old printing functions was called."""
+    warnings.warn(
+        "{0}() is deprecated; use {1}() instead".format(name, replacement),
+        DeprecationWarning,
+        stacklevel=3,
+    )
+
+
 def update_bookmarks(bookmarks, args):
-    """Loop through and update all bookmarks."""
+    """Loop through and update all bookmarks, printing the results.
+
+    Deprecated: use iter_updates(), which yields results instead of printing.
+    """
+    from gitup.render import LiveProgress, render
+
+    _warn_deprecated("update_bookmarks", "iter_updates")
     if not bookmarks:
         print("You don't have any bookmarks configured! Get help with 'gitup -h'.")
         return
-
-    for path in bookmarks:
-        _dispatch(path, _update_repository, args)
+    options = _legacy_options(args)
+    options.progress = LiveProgress()
+    render(iter_updates(bookmarks, options), options.progress)
 
 
 def update_directories(paths, args):
-    """Update a list of directories supplied by command arguments."""
-    for path in paths:
-        _dispatch(path, _update_repository, args)
+    """Update a list of directories supplied by command arguments, printing the
+    results.
+
+    Deprecated: use iter_updates(), which yields results instead of printing.
+    """
+    from gitup.render import LiveProgress, render
+
+    _warn_deprecated("update_directories", "iter_updates")
+    options = _legacy_options(args)
+    options.progress = LiveProgress()
+    render(iter_updates(paths, options), options.progress)
 
 
 def run_command(paths, args):
-    """Run an arbitrary shell command on all repos."""
-    for path in paths:
-        _dispatch(path, _run_command, args)
+    """Run an arbitrary shell command on all repos, printing the results.
+
+    Deprecated: use iter_commands(), which yields results instead of printing.
+    """
+    from gitup.render import render
+
+    _warn_deprecated("run_command", "iter_commands")
+    render(iter_commands(paths, _legacy_options(args)))